@@ -33,8 +33,11 @@ def configure_redis(cache_url=None, _client=None):
         db = int(url.path[1:])
     else:
         db = 0
-    pool = redis.ConnectionPool(
+    # Wait for a free connection instead of failing, when all pooled
+    # connections are in use.
+    pool = redis.BlockingConnectionPool(
         max_connections=20,
+        timeout=5.0,
         host=host,
         port=port,
         db=db,
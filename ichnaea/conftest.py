@@ -494,12 +494,15 @@ def app(request, db, raven, redis):
 
 
 @pytest.fixture(scope="session")
-def global_celery(db_independent_session, geoip_db, raven_client, redis_client):
+def global_celery(
+    db_independent_session, geoip_db, http_session, raven_client, redis_client
+):
     """Yield and cleanup a taskapp based on independent sessions."""
     init_worker(
         celery_app,
         _db=db_independent_session,
         _geoip_db=geoip_db,
+        _http_session=http_session,
         _raven_client=raven_client,
         _redis_client=redis_client,
     )
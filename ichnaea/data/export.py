@@ -1,16 +1,14 @@
 from collections import defaultdict
-import json
-import re
+from functools import lru_cache
+import os
 import time
 from urllib.parse import urlparse
-import uuid
 
 import boto3
 import boto3.exceptions
 import botocore.exceptions
 import markus
 import redis.exceptions
-import requests
 import requests.exceptions
 from sqlalchemy import select
 import sqlalchemy.exc
@@ -35,8 +33,6 @@ from ichnaea.models.content import encode_datamap_grid
 from ichnaea import util
 
 
-WHITESPACE = re.compile(r"\s", flags=re.UNICODE)
-
 METRICS = markus.get_metrics()
 
 
@@ -63,19 +59,42 @@ class IncomingQueue(object):
         grouped = defaultdict(list)
         for item in data:
             grouped[(item["api_key"], item.get("source", "gnss"))].append(
-                {"api_key": item["api_key"], "report": item["report"]}
+                item["report"]
             )
 
         with self.task.db_session(commit=False) as session:
             export_configs = ExportConfig.all(session)
 
+        # Aggregate items by their target queue, so each queue gets
+        # a single push and expire command. Each report is encoded once
+        # per queued format, with or without metadata, and the encoded
+        # bytes are shared by all export queues using that format.
+        queued = defaultdict(list)
+        for (api_key, source), reports in grouped.items():
+            encoded = {}
+            for config in export_configs:
+                if not config.allowed(api_key, source):
+                    continue
+
+                metadata = config.queue_metadata
+                if metadata not in encoded:
+                    if metadata:
+                        encoded[metadata] = [
+                            util.encode_json({"api_key": api_key, "report": report})
+                            for report in reports
+                        ]
+                    else:
+                        encoded[metadata] = [
+                            util.encode_json(report) for report in reports
+                        ]
+
+                queue_key = config.queue_key(api_key, source)
+                queued[(config, queue_key)].extend(encoded[metadata])
+
         with self.task.redis_pipeline() as pipe:
-            for (api_key, source), items in grouped.items():
-                for config in export_configs:
-                    if config.allowed(api_key, source):
-                        queue_key = config.queue_key(api_key, source)
-                        queue = config.queue(queue_key, redis_client)
-                        queue.enqueue(items, pipe=pipe)
+            for (config, queue_key), items in queued.items():
+                queue = config.queue(queue_key, redis_client, json=False)
+                queue.enqueue(items, pipe=pipe)
 
         for config in export_configs:
             # Check all queues if they now contain enough data or
@@ -99,7 +118,9 @@ class ReportExporter(object):
         self.task = task
         self.config = config
         self.queue_key = queue_key
-        self.queue = config.queue(queue_key, task.redis_client)
+        self.queue = config.queue(
+            queue_key, task.redis_client, json=config.queue_metadata
+        )
         self.stats_tags = ["key:" + self.config.name]
 
     @staticmethod
@@ -143,6 +164,36 @@ class ReportExporter(object):
     def send(self, queue_items):
         raise NotImplementedError()
 
+    @staticmethod
+    def _unwrap_report(item):
+        # Items queued by older releases wrap the report together
+        # with its metadata, forward only the report for those.
+        if item.startswith(b'{"api_key"'):
+            value = util.decode_json(item)
+            if "report" in value:
+                return util.encode_json(value["report"])
+        return item
+
+    def encode_reports(self, queue_items, compresslevel=6, batch=100):
+        """
+        Return the gzip compressed JSON payload for queue items which
+        are already JSON encoded reports, without decoding them.
+
+        The reports are joined and compressed in slices of `batch`
+        items, so the uncompressed payload never exists in one piece.
+        """
+        reports = [self._unwrap_report(item) for item in queue_items]
+
+        def chunks():
+            yield b'{"items":['
+            for i in range(0, len(reports), batch):
+                if i:
+                    yield b","
+                yield b",".join(reports[i : i + batch])
+            yield b"]}"
+
+        return util.encode_gzip_chunks(chunks(), compresslevel=compresslevel)
+
 
 class DummyExporter(ReportExporter):
     def send(self, queue_items):
@@ -154,20 +205,15 @@ class GeosubmitExporter(ReportExporter):
     _retriable = (IOError, requests.exceptions.RequestException)
 
     def send(self, queue_items):
-        # ignore metadata
-        reports = [item["report"] for item in queue_items]
-
         headers = {
             "Content-Encoding": "gzip",
             "Content-Type": "application/json",
             "User-Agent": "ichnaea",
         }
 
-        response = requests.post(
+        response = self.task.http_session.post(
             self.config.url,
-            data=util.encode_gzip(
-                json.dumps({"items": reports}).encode(), compresslevel=5
-            ),
+            data=self.encode_reports(queue_items, compresslevel=5),
             headers=headers,
             timeout=60.0,
         )
@@ -189,16 +235,32 @@ class S3Exporter(ReportExporter):
         botocore.exceptions.BotoCoreError,
     )
 
-    def send(self, queue_items):
-        # ignore metadata
-        reports = [item["report"] for item in queue_items]
+    _client = None
 
-        _, bucketname, path = urlparse(self.config.url)[:3]
+    @classmethod
+    def s3_client(cls):
+        """Return a S3 client, created once per process."""
+        if cls._client is None:
+            cls._client = boto3.client("s3")
+        return cls._client
+
+    @staticmethod
+    @lru_cache(maxsize=100)
+    def s3_location(url):
+        """
+        Return the bucket name and object name template for an export
+        URL. The result is cached, as the URL only changes with the
+        export configuration.
+        """
+        _, bucketname, path = urlparse(url)[:3]
         # s3 key names start without a leading slash
         path = path.lstrip("/")
         if not path.endswith("/"):
             path += "/"
+        return (bucketname, path)
 
+    def send(self, queue_items):
+        bucketname, path = self.s3_location(self.config.url)
         year, month, day = util.utcnow().timetuple()[:3]
 
         # strip away queue prefix again
@@ -209,19 +271,19 @@ class S3Exporter(ReportExporter):
         obj_name = path.format(
             source=source, api_key=api_key, year=year, month=month, day=day
         )
-        obj_name += uuid.uuid1().hex + ".json.gz"
+        obj_name += os.urandom(16).hex() + ".json.gz"
 
         try:
-            data = util.encode_gzip(
-                json.dumps({"items": reports}).encode(), compresslevel=7
+            data = self.encode_reports(queue_items, compresslevel=7)
+
+            self.s3_client().put_object(
+                Bucket=bucketname,
+                Key=obj_name,
+                Body=data,
+                ContentEncoding="gzip",
+                ContentType="application/json",
             )
 
-            s3 = boto3.resource("s3")
-            bucket = s3.Bucket(bucketname)
-
-            obj = bucket.Object(obj_name)
-            obj.put(Body=data, ContentEncoding="gzip", ContentType="application/json")
-
             METRICS.incr(
                 "data.export.upload", tags=self.stats_tags + ["status:success"]
             )
@@ -286,48 +348,73 @@ class InternalTransform(object):
         ("signalStrength", "signal"),
     ]
 
-    def _map_dict(self, item_source, field_map):
-        value = {}
-        for spec in field_map:
-            if isinstance(spec, tuple):
-                source, target = spec
-            else:
-                source = spec
-                target = spec
-            source_value = item_source.get(source)
-            if source_value is not None:
-                value[target] = source_value
-        return value
-
-    def _parse_dict(self, item, report, key_map, field_map):
-        value = {}
-        item_source = item.get(key_map[0])
-        if item_source:
-            value = self._map_dict(item_source, field_map)
-        if value:
-            if key_map[1] is None:
-                report.update(value)
-            else:
-                report[key_map[1]] = value
-        return value
+    def __init__(self):
+        self._parse_position = self._dict_parser(self.position_id, self.position_map)
+        self._parse_blue = self._list_parser(self.blue_id, self.blue_map)
+        self._parse_cell = self._list_parser(self.cell_id, self.cell_map)
+        self._parse_wifi = self._list_parser(self.wifi_id, self.wifi_map)
+
+    @staticmethod
+    def _field_mapper(field_map):
+        # normalize the field map into (source, target) pairs once,
+        # instead of checking each spec for every mapped item
+        fields = tuple(
+            spec if isinstance(spec, tuple) else (spec, spec) for spec in field_map
+        )
 
-    def _parse_list(self, item, report, key_map, field_map):
-        values = []
-        for value_item in item.get(key_map[0], ()):
-            value = self._map_dict(value_item, field_map)
+        def map_dict(item_source):
+            get = item_source.get
+            return {
+                target: value
+                for source, target in fields
+                if (value := get(source)) is not None
+            }
+
+        return map_dict
+
+    @classmethod
+    def _dict_parser(cls, key_map, field_map):
+        source_key, target_key = key_map
+        map_dict = cls._field_mapper(field_map)
+
+        def parse_dict(item, report):
+            value = {}
+            item_source = item.get(source_key)
+            if item_source:
+                value = map_dict(item_source)
             if value:
-                values.append(value)
-        if values:
-            report[key_map[1]] = values
-        return values
+                if target_key is None:
+                    report.update(value)
+                else:
+                    report[target_key] = value
+            return value
+
+        return parse_dict
+
+    @classmethod
+    def _list_parser(cls, key_map, field_map):
+        source_key, target_key = key_map
+        map_dict = cls._field_mapper(field_map)
+
+        def parse_list(item, report):
+            values = []
+            for value_item in item.get(source_key, ()):
+                value = map_dict(value_item)
+                if value:
+                    values.append(value)
+            if values:
+                report[target_key] = values
+            return values
+
+        return parse_list
 
     def __call__(self, item):
         report = {}
-        self._parse_dict(item, report, self.position_id, self.position_map)
+        self._parse_position(item, report)
 
-        blues = self._parse_list(item, report, self.blue_id, self.blue_map)
-        cells = self._parse_list(item, report, self.cell_id, self.cell_map)
-        wifis = self._parse_list(item, report, self.wifi_id, self.wifi_map)
+        blues = self._parse_blue(item, report)
+        cells = self._parse_cell(item, report)
+        wifis = self._parse_wifi(item, report)
 
         position = item.get("position") or {}
         gps_age = position.get("age", 0)
@@ -353,58 +440,51 @@ class InternalExporter(ReportExporter):
     transform = InternalTransform()
 
     def send(self, queue_items):
-        api_keys = set()
         api_keys_known = set()
-        metrics = {}
-
-        items = []
-        for item in queue_items:
-            # preprocess items and extract set of API keys
-            item["report"] = self.transform(item["report"])
-            if item["report"]:
-                items.append(item)
-                api_keys.add(item["api_key"])
-
-        for api_key in api_keys:
-            metrics[api_key] = {}
-            for type_ in ("report", "blue", "cell", "wifi"):
-                for action in ("drop", "upload"):
-                    metrics[api_key]["%s_%s" % (type_, action)] = 0
-
-        with self.task.db_session(commit=False) as session:
-            # limit database session to get API keys
-            keys = [key for key in api_keys if key]
-            if keys:
-                columns = ApiKey.__table__.c
-                rows = session.execute(
-                    select([columns.valid_key]).where(columns.valid_key.in_(keys))
-                ).fetchall()
-
-                for row in rows:
-                    api_keys_known.add(row.valid_key)
-
+        metrics = defaultdict(lambda: defaultdict(int))
         positions = []
         observations = {"blue": [], "cell": [], "wifi": []}
 
-        for item in items:
-            api_key = item["api_key"]
-            report = item["report"]
+        for item in queue_items:
+            if "report" not in item:
+                # Plain reports, queued while the export had a
+                # report-only schema, lack the API key metadata.
+                metrics[None]["report_drop"] += 1
+                continue
+
+            # transform and process each report in a single pass
+            report = self.transform(item["report"])
+            if not report:
+                continue
 
-            obs, malformed_obs = self.process_report(report)
+            key_metrics = metrics[item["api_key"]]
+            added_obs, malformed_obs = self.process_report(report, observations)
 
             any_data = False
             for name in ("blue", "cell", "wifi"):
-                if obs.get(name):
-                    observations[name].extend(obs[name])
-                    metrics[api_key][name + "_upload"] += len(obs[name])
+                if added_obs.get(name):
+                    key_metrics[name + "_upload"] += added_obs[name]
                     any_data = True
-                metrics[api_key][name + "_drop"] += malformed_obs.get(name, 0)
+                key_metrics[name + "_drop"] += malformed_obs.get(name, 0)
 
-            metrics[api_key]["report_upload"] += 1
+            key_metrics["report_upload"] += 1
             if any_data:
                 positions.append((report["lat"], report["lon"]))
             else:
-                metrics[api_key]["report_drop"] += 1
+                key_metrics["report_drop"] += 1
+
+        keys = [key for key in metrics if key]
+        if keys:
+            # look up all API keys in a single query, limiting the
+            # database session to it
+            with self.task.db_session(commit=False) as session:
+                columns = ApiKey.__table__.c
+                rows = session.execute(
+                    select([columns.valid_key]).where(columns.valid_key.in_(keys))
+                ).fetchall()
+
+            for row in rows:
+                api_keys_known.add(row.valid_key)
 
         with self.task.redis_pipeline() as pipe:
             self.queue_observations(pipe, observations)
@@ -414,9 +494,11 @@ class InternalExporter(ReportExporter):
         self.emit_metrics(api_keys_known, metrics)
 
     def queue_observations(self, pipe, observations):
+        # Cells are sharded by radio type, use the validated radio
+        # directly instead of encoding and decoding the cellid.
         for datatype, shard_model, shard_key, queue_prefix in (
             ("blue", BlueShard, "mac", "update_blue_"),
-            ("cell", CellShard, "cellid", "update_cell_"),
+            ("cell", CellShard, "radio", "update_cell_"),
             ("wifi", WifiShard, "mac", "update_wifi_"),
         ):
 
@@ -433,42 +515,57 @@ class InternalExporter(ReportExporter):
                 queue.enqueue(values, pipe=pipe)
 
     def emit_metrics(self, api_keys_known, metrics):
+        # Sum up the counts per metric and tags first, so all unknown
+        # API keys sharing the same tags are sent as a single metric.
+        totals = defaultdict(int)
         for api_key, key_metrics in metrics.items():
-            api_tag = []
+            api_tag = ()
             if api_key and api_key in api_keys_known:
-                api_tag = ["key:%s" % api_key]
+                api_tag = ("key:%s" % api_key,)
 
             for name, count in key_metrics.items():
-                if not count:
-                    continue
+                if count:
+                    totals[(name, api_tag)] += count
+
+        for (name, api_tag), count in totals.items():
+            type_, action = name.split("_")
+            if type_ == "report":
+                suffix = "report"
+                tags = list(api_tag)
+            else:
+                suffix = "observation"
+                tags = ["type:%s" % type_] + list(api_tag)
 
-                type_, action = name.split("_")
-                if type_ == "report":
-                    suffix = "report"
-                    tags = api_tag
-                else:
-                    suffix = "observation"
-                    tags = ["type:%s" % type_] + api_tag
+            METRICS.incr("data.%s.%s" % (suffix, action), count, tags=tags)
 
-                METRICS.incr("data.%s.%s" % (suffix, action), count, tags=tags)
+    def process_report(self, data, observations):
+        """
+        Validate a single report and add its observations to the
+        per-datatype lists in the passed in observations dict.
 
-    def process_report(self, data):
+        Returns a tuple of the number of added and malformed
+        observations per datatype.
+        """
         report = Report.create(**data)
         if report is None:
             return ({}, {})
 
+        added = {}
         malformed = {}
-        observations = {}
+        # observations are only de-duplicated within a single report,
+        # the same dict is reused for each datatype
+        report_obs = {}
         for name, report_cls, obs_cls in (
             ("blue", BlueReport, BlueObservation),
             ("cell", CellReport, CellObservation),
             ("wifi", WifiReport, WifiObservation),
         ):
 
+            added[name] = 0
             malformed[name] = 0
-            observations[name] = {}
 
             if data.get(name):
+                report_obs.clear()
                 for item in data[name]:
                     # validate the blue/cell/wifi specific fields
                     item_report = report_cls.create(**item)
@@ -481,18 +578,16 @@ class InternalExporter(ReportExporter):
                     item_key = item_obs.unique_key
 
                     # if we have better data for the same key, ignore
-                    existing = observations[name].get(item_key)
+                    existing = report_obs.get(item_key)
                     if existing is not None and existing.better(item_obs):
                         continue
 
-                    observations[name][item_key] = item_obs
+                    report_obs[item_key] = item_obs
 
-        obs = {
-            "blue": observations["blue"].values(),
-            "cell": observations["cell"].values(),
-            "wifi": observations["wifi"].values(),
-        }
-        return (obs, malformed)
+                observations[name].extend(report_obs.values())
+                added[name] = len(report_obs)
+
+        return (added, malformed)
 
     def process_datamap(self, pipe, positions):
         grids = set()
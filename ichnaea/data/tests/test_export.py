@@ -2,11 +2,16 @@ import json
 import time
 from unittest import mock
 
-import boto3
 import pytest
+import redis.exceptions
 import requests_mock
 
-from ichnaea.data.export import DummyExporter, InternalTransform
+from ichnaea.data.export import (
+    DummyExporter,
+    InternalExporter,
+    InternalTransform,
+    S3Exporter,
+)
 from ichnaea.data.tasks import update_blue, update_cell, update_incoming, update_wifi
 from ichnaea.models import BlueShard, CellShard, WifiShard
 from ichnaea.tests.factories import (
@@ -215,6 +220,59 @@ class TestGeosubmit(BaseExportTest):
         )
         metricsmock.assert_timing_once("data.export.upload.timing", tags=["key:test"])
 
+    def test_http_session(self, celery, session):
+        """Uploads use the pooled HTTP session of the worker."""
+        ExportConfigFactory(
+            name="test",
+            batch=1,
+            schema="geosubmit",
+            url="http://127.0.0.1:9/v2/geosubmit?key=external",
+        )
+        session.flush()
+        self.add_reports(celery, 1)
+
+        http_session = celery.http_session
+        with requests_mock.Mocker() as mocker:
+            mocker.register_uri("POST", requests_mock.ANY, text="{}")
+            with mock.patch.object(
+                http_session, "post", wraps=http_session.post
+            ) as mock_post:
+                update_incoming.delay().get()
+
+        assert mock_post.call_count == 1
+        assert mocker.call_count == 1
+
+    def test_upload_wrapped(self, celery, redis, session):
+        """Items queued with their metadata by older releases are unwrapped."""
+        ExportConfigFactory(
+            name="test",
+            batch=3,
+            schema="geosubmit",
+            url="http://127.0.0.1:9/v2/geosubmit?key=external",
+        )
+        session.flush()
+
+        reports = self.add_reports(celery, 2)
+        redis.rpush(
+            "queue_export_test",
+            json.dumps({"api_key": "test", "report": reports[0]}).encode(),
+        )
+
+        with requests_mock.Mocker() as mock:
+            mock.register_uri("POST", requests_mock.ANY, text="{}")
+            update_incoming.delay().get()
+
+        assert mock.call_count == 1
+        body = util.decode_gzip(mock.request_history[0].body)
+        send_reports = json.loads(body)["items"]
+        assert len(send_reports) == 3
+        for report in send_reports:
+            assert "report" not in report
+            assert "api_key" not in report
+        expect = [report["position"]["accuracy"] for report in reports]
+        gotten = [report["position"]["accuracy"] for report in send_reports]
+        assert set(expect) == set(gotten)
+
 
 class TestS3(BaseExportTest):
     def test_upload(self, celery, session, metricsmock):
@@ -234,24 +292,18 @@ class TestS3(BaseExportTest):
         self.add_reports(celery, 3, api_key=None)
         self.add_reports(celery, 3, api_key="no-position", set_position=False)
 
-        mock_conn = mock.MagicMock()
-        mock_bucket = mock.MagicMock()
-        mock_obj = mock.MagicMock()
-        mock_conn.return_value.Bucket.return_value = mock_bucket
-        mock_bucket.Object.return_value = mock_obj
-
-        with mock.patch.object(boto3, "resource", mock_conn):
+        mock_client = mock.MagicMock()
+        with mock.patch.object(S3Exporter, "_client", mock_client):
             update_incoming.delay().get()
 
-        obj_calls = mock_bucket.Object.call_args_list
-        put_calls = mock_obj.put.call_args_list
-        assert len(obj_calls) == 5
+        put_calls = mock_client.put_object.call_args_list
         assert len(put_calls) == 5
 
         keys = []
         test_export = None
-        for obj_call, put_call in zip(obj_calls, put_calls):
-            s3_key = obj_call[0][0]
+        for put_call in put_calls:
+            assert put_call[1]["Bucket"] == "bucket"
+            s3_key = put_call[1]["Key"]
             assert s3_key.startswith("backups/")
             assert s3_key.endswith(".json.gz")
             assert put_call[1]["Body"]
@@ -310,6 +362,19 @@ class TestS3(BaseExportTest):
             == 5
         )
 
+    def test_s3_location(self):
+        assert S3Exporter.s3_location("s3://bucket/backups/{api_key}") == (
+            "bucket",
+            "backups/{api_key}/",
+        )
+
+    def test_client(self):
+        with mock.patch.object(S3Exporter, "_client", None):
+            with mock.patch("ichnaea.data.export.boto3.client") as mock_client:
+                client = S3Exporter.s3_client()
+                assert S3Exporter.s3_client() is client
+            mock_client.assert_called_once_with("s3")
+
 
 class TestInternalTransform(object):
 
@@ -528,6 +593,50 @@ class TestInternal(BaseExportTest):
             ("data.station.new", ("type:wifi",)): 24,
         }
 
+    def test_stats_unknown_keys(self, celery, session, metricsmock):
+        self.add_reports(celery, 2, api_key="unknown-1")
+        self.add_reports(celery, 1, api_key="unknown-2")
+        self.add_reports(celery, 1, api_key=None)
+        self._update_all(session, datamap_only=True)
+
+        metricsmock.assert_incr_once("data.report.upload", value=4, tags=[])
+        metricsmock.assert_incr_once(
+            "data.observation.upload", value=4, tags=["type:cell"]
+        )
+
+    def test_retry(self, celery, session, metricsmock):
+        """A retried send processes the same reports again."""
+        reports = self.add_reports(celery, 2, cell_factor=0, wifi_factor=1)
+
+        num = [0]
+        orig_queue = InternalExporter.queue_observations
+        orig_wait = InternalExporter._retry_wait
+
+        def mock_queue(self, pipe, observations, num=num):
+            num[0] += 1
+            if num[0] == 1:
+                raise redis.exceptions.RedisError()
+            return orig_queue(self, pipe, observations)
+
+        with mock.patch(
+            "ichnaea.data.export.InternalExporter.queue_observations", mock_queue
+        ):
+            try:
+                InternalExporter._retry_wait = 0.001
+                self._update_all(session)
+            finally:
+                InternalExporter._retry_wait = orig_wait
+
+        assert num[0] == 2
+        for report in reports:
+            mac = report["wifiAccessPoints"][0]["macAddress"]
+            shard = WifiShard.shard_model(mac)
+            assert session.query(shard).filter(shard.mac == mac).count() == 1
+        metricsmock.assert_incr_once("data.report.upload", value=2, tags=["key:test"])
+        metricsmock.assert_incr_once(
+            "data.observation.upload", value=2, tags=["type:wifi", "key:test"]
+        )
+
     def test_blue(self, celery, session):
         reports = self.add_reports(celery, blue_factor=1, cell_factor=0, wifi_factor=0)
         self._update_all(session)
@@ -682,6 +791,17 @@ class TestInternal(BaseExportTest):
             "data.observation.upload", tags=["type:wifi", "key:test"]
         )
 
+    def test_plain_report(self, celery, redis, session, metricsmock):
+        """Reports queued without metadata by another schema are dropped."""
+        reports = self.add_reports(celery, 1, cell_factor=0, wifi_factor=1)
+        redis.rpush("queue_export_internal", json.dumps(reports[0]).encode())
+        self._update_all(session)
+
+        shard = WifiShard.shard_model(reports[0]["wifiAccessPoints"][0]["macAddress"])
+        assert session.query(shard).count() == 1
+        metricsmock.assert_incr_once("data.report.upload", value=1, tags=["key:test"])
+        metricsmock.assert_incr_once("data.report.drop", value=1, tags=[])
+
     def test_no_observations(self, celery, session):
         self.add_reports(celery, 1, cell_factor=0, wifi_factor=0)
         self._update_all(session)
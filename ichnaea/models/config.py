@@ -39,6 +39,15 @@ class ExportConfig(_Model):
             session.expunge(row)
         return row
 
+    @property
+    def queue_metadata(self):
+        """
+        Do queued items include metadata like the API key? Exports
+        which only forward the reports get the encoded reports queued
+        as is, so they can be sent without being decoded again.
+        """
+        return self.schema not in ("geosubmit", "s3")
+
     def allowed(self, api_key, source):
         skip_keys = self.skip_keys or ()
         skip_sources = self.skip_sources or ()
@@ -62,12 +71,12 @@ class ExportConfig(_Model):
             return "queue_export_%s:%s:%s" % (self.name, source, api_key)
         return "queue_export_" + self.name
 
-    def queue(self, queue_key, redis_client):
+    def queue(self, queue_key, redis_client, json=True):
         return DataQueue(
             queue_key,
             redis_client,
             "exports",
             batch=self.batch,
             compress=False,
-            json=True,
+            json=json,
         )
@@ -72,6 +72,12 @@ class TestExportConfig(object):
         test("query", "test", "query", False)
         test("query", "test2", None, False)
 
+    def test_queue_metadata(self):
+        assert ExportConfig(schema="dummy").queue_metadata
+        assert ExportConfig(schema="internal").queue_metadata
+        assert not ExportConfig(schema="geosubmit").queue_metadata
+        assert not ExportConfig(schema="s3").queue_metadata
+
     def test_skip_keys(self, session):
         non_ascii = b"\xc3\xa4".decode("utf-8")
         configs = [
@@ -2,8 +2,6 @@
 Functionality related to custom Redis based queues.
 """
 
-import json
-
 from ichnaea.cache import redis_pipeline
 from ichnaea import util
 
@@ -50,7 +48,7 @@ class DataQueue(object):
             if self.compress:
                 result = [util.decode_gzip(item) for item in result]
             if self.json:
-                result = [json.loads(item.decode("utf-8")) for item in result]
+                result = [util.decode_json(item) for item in result]
 
         return result
 
@@ -75,7 +73,7 @@ class DataQueue(object):
             batch = len(items)
 
         if self.json:
-            items = [json.dumps(item).encode("utf-8") for item in items]
+            items = [util.encode_json(item) for item in items]
 
         if self.compress:
             items = [util.encode_gzip(item) for item in items]
@@ -20,6 +20,7 @@ class TestUtil(object):
         now = util.utcnow()
         assert isinstance(now, datetime)
         assert now.tzinfo == ZoneInfo("UTC")
+        assert now.microsecond == 0
 
     def test_encode_gzip(self):
         data = util.encode_gzip(b"foo")
@@ -35,12 +36,25 @@ class TestUtil(object):
         data = util.decode_gzip(util.encode_gzip(b"foo"))
         assert data == b"foo"
 
+    def test_encode_gzip_chunks(self):
+        data = util.encode_gzip_chunks([b"f", b"", b"oo"])
+        assert util.decode_gzip(data) == b"foo"
+
     def test_decode_gzip_error(self):
         with pytest.raises(GZIPDecodeError):
             util.decode_gzip(self.gzip_foo[:1])
         with pytest.raises(GZIPDecodeError):
             util.decode_gzip(self.gzip_foo[:5])
 
+    def test_encode_json(self):
+        data = util.encode_json({"a": [1, "b"]})
+        assert isinstance(data, bytes)
+        assert util.decode_json(data) == {"a": [1, "b"]}
+
+    def test_decode_json(self):
+        assert util.decode_json(b'{"a": 1}') == {"a": 1}
+        assert util.decode_json('{"a": 1}') == {"a": 1}
+
     @pytest.mark.parametrize(
         "secret_key,reason,parts,expected_prefix",
         (
@@ -2,6 +2,7 @@ from contextlib import contextmanager
 from datetime import datetime
 import gzip
 from hashlib import sha512
+import io
 from itertools import zip_longest
 import json
 import os
@@ -9,6 +10,7 @@ import shutil
 import struct
 import sys
 import tempfile
+import time
 import zlib
 
 from zoneinfo import ZoneInfo
@@ -39,6 +41,20 @@ def encode_gzip(data, compresslevel=6):
     return gzip.compress(data, compresslevel=compresslevel)
 
 
+def encode_gzip_chunks(chunks, compresslevel=6):
+    """
+    Encode the passed in iterable of byte chunks with gzip, without
+    joining the uncompressed chunks into a single buffer first.
+    """
+    buf = io.BytesIO()
+    with gzip.GzipFile(
+        fileobj=buf, mode="wb", compresslevel=compresslevel
+    ) as gzip_file:
+        for chunk in chunks:
+            gzip_file.write(chunk)
+    return buf.getvalue()
+
+
 def decode_gzip(data):
     """Return the gzip-decompressed bytes.
 
@@ -50,6 +66,16 @@ def decode_gzip(data):
         raise GZIPDecodeError(repr(exc))
 
 
+def encode_json(data):
+    """Return the JSON encoded data as UTF-8 bytes."""
+    return json.dumps(data).encode("utf-8")
+
+
+def decode_json(data):
+    """Return the decoded JSON data, passed in as bytes or str."""
+    return json.loads(data)
+
+
 @contextmanager
 def selfdestruct_tempdir():
     base_path = tempfile.mkdtemp()
@@ -61,7 +87,8 @@ def selfdestruct_tempdir():
 
 def utcnow():
     """Return the current time in UTC with a UTC timezone set."""
-    return datetime.utcnow().replace(microsecond=0, tzinfo=UTC)
+    # integer seconds drop the microseconds, without a second datetime
+    return datetime.fromtimestamp(int(time.time()), UTC)
 
 
 def version_info():